@@ -0,0 +1,172 @@
+"""
+Rendering of Handlebars templates for the HTML output of populate.
+
+Pybars is slow, both when compiling and when rendering a template. Most of the
+templates (including the built-in ones) use only a small subset of Handlebars:
+variables, `each` and `if` blocks. If Jinja2 is available, we translate such
+templates to Jinja2 and render them with it. Templates using any other
+construct are rendered by pybars. Setting the environment variable
+PCBDRAW_TEMPLATE_ENGINE to "pybars" forces pybars for all templates.
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+__all__ = [
+    "compile_template",
+    "handlebars_to_jinja",
+]
+
+TemplateFn = Callable[[Dict[str, Any]], Iterable[str]]
+
+_TAG_RE = re.compile(r"\{\{\{\s*([^{}]*?)\s*\}\}\}|\{\{\s*([^{}]*?)\s*\}\}")
+_PATH_RE = re.compile(r"^this(\.[A-Za-z_]\w*)*$|^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$")
+_ESCAPE_RE = re.compile(r"[&<>\"'`]")
+_ESCAPE_TABLE = {
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;",
+    "`": "&#x60;",
+}
+
+
+def _stringify(value: Any) -> str:
+    if value is None:
+        return ""
+    return str(value)
+
+def _escape(value: Any) -> str:
+    return _ESCAPE_RE.sub(lambda m: _ESCAPE_TABLE[m.group(0)], _stringify(value))
+
+def _each_items(value: Any) -> Iterable[Any]:
+    """
+    Items iterated by the each block. Like pybars, iterate over values of
+    mappings and over nothing for values without length.
+    """
+    try:
+        if len(value) == 0:
+            return ()
+    except TypeError:
+        return ()
+    if hasattr(value, "keys"):
+        return value.values() # type: ignore
+    return value # type: ignore
+
+def _is_plain_literal(text: str) -> bool:
+    """
+    Check that the text cannot be interpreted as Jinja2 syntax
+    """
+    return not any(x in text for x in ["{{", "{%", "{#"]) and not text.endswith("{")
+
+def _translate_path(path: str, depth: int) -> Optional[str]:
+    """
+    Translate Handlebars path to Jinja2 expression. Inside a block, only paths
+    relative to `this` are supported as Jinja2 doesn't change the context.
+    Return None for unsupported paths.
+    """
+    if _PATH_RE.match(path) is None:
+        return None
+    if depth > 0 and path != "this" and not path.startswith("this."):
+        return None
+    # Jinja2 prefers attributes over items for the dot notation, so we use
+    # subscripts; otherwise a key like "items" would resolve to a dict method
+    head, *keys = path.split(".")
+    return head + "".join(f"[{key!r}]" for key in keys)
+
+def handlebars_to_jinja(template: str) -> Optional[str]:
+    """
+    Translate a Handlebars template to an equivalent Jinja2 template. Return
+    None if the template uses a construct that cannot be translated.
+    """
+    output: List[str] = []
+    blocks: List[List[Any]] = [] # Open blocks as [kind, has else]
+    depth = 0 # Number of nested each blocks
+    position = 0
+    for m in _TAG_RE.finditer(template):
+        literal = template[position:m.start()]
+        if not _is_plain_literal(literal):
+            return None
+        output.append(literal)
+        position = m.end()
+        raw, content = m.group(1), m.group(2)
+        if raw is not None:
+            path = _translate_path(raw, depth)
+            if path is None:
+                return None
+            output.append(f"{{{{ {path}|hbs_raw }}}}")
+        elif content.startswith("!"):
+            continue
+        elif content.startswith("#"):
+            kind, _, argument = content[1:].partition(" ")
+            path = _translate_path(argument.strip(), depth)
+            if kind not in ["each", "if"] or path is None:
+                return None
+            blocks.append([kind, False])
+            if kind == "each":
+                output.append(f"{{% for this in {path}|hbs_each %}}")
+                depth += 1
+            else:
+                output.append(f"{{% if {path} %}}")
+        elif content.startswith("/"):
+            if len(blocks) == 0 or blocks.pop()[0] != content[1:].strip():
+                return None
+            if content[1:].strip() == "each":
+                output.append("{% endfor %}")
+                depth -= 1
+            else:
+                output.append("{% endif %}")
+        elif content == "else":
+            if len(blocks) == 0 or blocks[-1][1]:
+                return None
+            blocks[-1][1] = True
+            output.append("{% else %}")
+        else:
+            path = _translate_path(content, depth)
+            if path is None:
+                return None
+            output.append(f"{{{{ {path}|hbs_escape }}}}")
+    if len(blocks) != 0 or not _is_plain_literal(template[position:]):
+        return None
+    output.append(template[position:])
+    return "".join(output)
+
+def compile_template(template: str) -> TemplateFn:
+    """
+    Compile a Handlebars template into a function taking the context and
+    returning the rendered output as an iterable of string chunks. Compilation
+    is expensive, so the result is cached for repeated renders of the same
+    template.
+    """
+    use_jinja = os.environ.get("PCBDRAW_TEMPLATE_ENGINE", "") != "pybars"
+    return _compile_template(template, use_jinja)
+
+@lru_cache(maxsize=8)
+def _compile_template(template: str, use_jinja: bool) -> TemplateFn:
+    # Both of the engines are imported lazily as importing pybars is expensive
+    if use_jinja:
+        try:
+            import jinja2 # type: ignore
+        except ImportError:
+            use_jinja = False
+    translated = handlebars_to_jinja(template) if use_jinja else None
+    if translated is None:
+        import pybars # type: ignore
+        compiled = pybars.Compiler().compile(template)
+        # Pybars renders the whole output into a single string; return it as
+        # a single chunk, so it is not written character by character
+        def render_pybars(context: Dict[str, Any]) -> Iterable[str]:
+            return [str(compiled(context))]
+        return render_pybars
+    env = jinja2.Environment(autoescape=False, keep_trailing_newline=True,
+                             undefined=jinja2.ChainableUndefined)
+    env.filters["hbs_escape"] = _escape
+    env.filters["hbs_raw"] = _stringify
+    env.filters["hbs_each"] = _each_items
+    jinja_template = env.from_string(translated)
+    def render(context: Dict[str, Any]) -> Iterable[str]:
+        return jinja_template.generate(context, this=context) # type: ignore
+    return render
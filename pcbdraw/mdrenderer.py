@@ -37,15 +37,12 @@ class MdRenderer(BaseRenderer):
     def linebreak(self):
         return '\n'
 
-    def hrule(self):
+    def thematic_break(self):
         return '---\n'
 
     def heading(self, text, level, raw=None):
         return '#'*level + " " + text + '\n\n'
 
-    # Mistune 0.8.4 calls it header, not heading
-    header = heading
-
     def paragraph(self, text):
         return text + '\n\n'
 
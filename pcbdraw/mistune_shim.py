@@ -27,14 +27,5 @@ elif mistune_major_version == 2:
     InlineParser = mistune.inline_parser.InlineParser
     HTMLRenderer = mistune.renderers.HTMLRenderer
     BaseRenderer = mistune.renderers.BaseRenderer
-elif mistune_major_version == 0:
-
-    def _noop_processor(processor: mistune.Markdown) -> None:
-        pass
-
-    plugin_table = plugin_footnotes = _noop_processor
-    InlineParser = mistune.InlineLexer
-    HTMLRenderer = mistune.Renderer
-    BaseRenderer = mistune.Renderer
 else:
     raise Exception(f"Unsupported mistune version {mistune.__version__}")
@@ -9,9 +9,11 @@ import os
 import re
 import sysconfig
 import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from decimal import Decimal
-from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union, Any
+from functools import lru_cache
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple, TypeVar, Union, Any
 
 import numpy as np
 # We import the typing under try-catch to allow runtime for systems that have
@@ -26,7 +28,7 @@ try:
 
 except ImportError:
     pass
-from pcbdraw.unit import read_resistance
+from pcbdraw.unit import read_resistance, resistor_bands
 import svgpathtools # type: ignore
 from lxml import etree, objectify # type: ignore
 from pcbnewTransition import KICAD_VERSION, isV6, isV7, isV8, pcbnew # type: ignore
@@ -41,6 +43,13 @@ PKG_BASE = os.path.dirname(__file__)
 
 etree.register_namespace("xlink", "http://www.w3.org/1999/xlink")
 
+# Tag and attribute names used when building the component layer; they are
+# shared among all the placed components
+_G_TAG = "g"
+_USE_TAG = "use"
+_RECT_TAG = "rect"
+_XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
 LEGACY_KICAD = not isV6() and not isV7() and not isV8()
 
 default_style = {
@@ -81,6 +90,7 @@ default_style = {
 }
 
 float_re = r'([-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)'
+units_re = re.compile(float_re + r'\s*(pt|pc|mm|cm|in)?')
 
 class SvgPathItem:
     def __init__(self, path: str) -> None:
@@ -245,6 +255,12 @@ def element_position(element: etree.Element, root: Optional[etree.Element]=None)
     return position[0][0] / position[2][0], position[1][0] / position[2][0]
 
 def get_global_datapaths() -> List[str]:
+    return list(_global_datapaths())
+
+@lru_cache(maxsize=1)
+def _global_datapaths() -> Tuple[str, ...]:
+    # The sysconfig queries are surprisingly expensive and the result cannot
+    # change during the lifetime of the process
     paths = []
     share = os.path.join('share', 'pcbdraw')
     scheme_names = sysconfig.get_scheme_names()
@@ -260,7 +276,7 @@ def get_global_datapaths() -> List[str]:
             paths.append(os.path.join(sysconfig.get_path('data', 'nt'), share))
     if len(paths) == 0:
         paths.append(os.path.join(sysconfig.get_path('data'), share))
-    return paths
+    return tuple(paths)
 
 def find_data_file(name: str, extension: str, data_paths: List[str], subdir: Optional[str]=None) -> Optional[str]:
     if not name.endswith(extension):
@@ -293,8 +309,7 @@ def to_kicad_basic_units(val: str) -> int:
     """
     Read string value and return it as KiCAD base units
     """
-    x = float_re + r'\s*(pt|pc|mm|cm|in)?'
-    value, unit = re.findall(x, val)[0]
+    value, unit = units_re.findall(val)[0]
     value = float(value)
     if unit == "" or unit == "px":
         return mm2ki(value * 25.4 / 96)
@@ -311,8 +326,7 @@ def to_kicad_basic_units(val: str) -> int:
     raise RuntimeError(f"Unknown units in '{val}'")
 
 def to_user_units(val: str) -> float:
-    x = float_re + r'\s*(pt|pc|mm|cm|in)?'
-    value_str, unit = re.findall(x, val)[0]
+    value_str, unit = units_re.findall(val)[0]
     value = float(value_str)
     if unit == "" or unit == "px":
         return value
@@ -342,30 +356,52 @@ def read_svg_unique(filename: str, prefix: str) -> etree.Element:
     return root
 
 def read_svg_unique2(filename: str, prefix: str) -> etree.Element:
-    root = etree.parse(filename).getroot()
+    content, ids = read_svg_source(filename)
+    return make_svg_unique(content, ids, prefix), prefix
+
+def read_svg_source(filename: str) -> Tuple[str, List[str]]:
+    """
+    Read SVG file and return its content together with the ids that have to
+    be prefixed to make the document unique. The result can be reused for
+    multiple instances of the document via make_svg_unique.
+    """
+    with open(filename) as f:
+        content = f.read()
+    root = etree.fromstring(str.encode(content))
     # We have to ensure all Ids in SVG are unique. Let's make it nasty by
     # collecting all ids and doing search & replace
     # Potentially dangerous (can break user text)
     ids = []
-    for el in root.getiterator():
+    for el in root.iter():
         if "id" in el.attrib and el.attrib["id"] != "origin":
             ids.append(el.attrib["id"])
-    with open(filename) as f:
-        content = f.read()
+    return content, ids
+
+def make_svg_unique(content: str, ids: List[str], prefix: str) -> etree.Element:
+    """
+    Parse SVG content obtained by read_svg_source and prefix all its ids
+    """
     for i in ids:
         content = content.replace("#"+i, "#" + prefix + i)
     root = etree.fromstring(str.encode(content))
-    for el in root.getiterator():
+    for el in root.iter():
         if "id" in el.attrib and el.attrib["id"] != "origin":
             el.attrib["id"] = prefix + el.attrib["id"]
-    return root, prefix
+    return root
+
+SVG_DESCRIPTION_TAGS = frozenset(["title", "desc"])
+SVG_EDITOR_TAGS = SVG_DESCRIPTION_TAGS | frozenset(["namedview", "metadata"])
 
-def extract_svg_content(root: etree.Element) -> List[etree.Element]:
+def extract_svg_content(root: etree.Element,
+                        skip: FrozenSet[str]=SVG_DESCRIPTION_TAGS) -> List[etree.Element]:
+    """
+    Return top-level elements of the SVG without the tags from skip
+    """
     # Remove SVG namespace to ease our lives and change ids
-    for el in root.getiterator():
+    for el in root.iter():
         if '}' in str(el.tag):
             el.tag = el.tag.split('}', 1)[1]
-    return [ x for x in root if x.tag and x.tag not in ["title", "desc"]]
+    return [x for x in root.iterchildren() if x.tag and x.tag not in skip]
 
 def strip_style_svg(root: etree.Element, keys: List[str], forbidden_colors: List[str]) -> bool:
     elements_to_remove = []
@@ -487,14 +523,40 @@ def load_style(style_file: str) -> Dict[str, Any]:
                                 .format(style_file, ", ".join(missing)))
     return style
 
+def flatten_style(style: Any, prefix: Tuple[Union[str, int], ...],
+                  output: Dict[Tuple[Union[str, int], ...], Any]) -> None:
+    """
+    Store every value of the (nested) style into output under the tuple of
+    keys leading to it. Existing entries are kept, so the first flattened
+    style takes precedence.
+    """
+    if not isinstance(style, dict):
+        return
+    for key, value in style.items():
+        path = prefix + (key,)
+        output.setdefault(path, value)
+        flatten_style(value, path, output)
+
 def load_remapping(remap_file: str) -> Dict[str, Tuple[str, str]]:
+    if remap_file is None:
+        return {}
+    try:
+        # The modification time is a part of the cache key, so changes of the
+        # file are picked up by long running processes
+        path = os.path.realpath(remap_file)
+        mtime = os.path.getmtime(path)
+    except OSError:
+        raise RuntimeError("Cannot open remapping file " + remap_file)
+    # The cached mapping is shared, give the caller its own copy
+    return dict(_load_remapping(path, mtime))
+
+@lru_cache(maxsize=16)
+def _load_remapping(remap_file: str, mtime: float) -> Dict[str, Tuple[str, str]]:
     def readMapping(s: str) -> Tuple[str, str]:
         x = s.split(":")
         if len(x) != 2:
             raise RuntimeError(f"Invalid remmaping value {s}")
         return x[0], x[1]
-    if remap_file is None:
-        return {}
     try:
         with open(remap_file, "r") as f:
             j = json.load(f)
@@ -687,10 +749,10 @@ class PlotSubstrate(PlotInterface):
             size = [self._plotter.ki2svg(coord) for coord in hole.drillsize]
             if size[0] == 0 or size[1] == 0:
                 continue
-            el = etree.SubElement(layer, "path")
-            el.attrib["d"] = hole.get_svg_path_d(self._plotter.ki2svg)
-            el.attrib["transform"] = "translate({} {}) rotate({})".format(
-                position[0], position[1], -hole.orientation.AsDegrees())
+            etree.SubElement(layer, "path",
+                d=hole.get_svg_path_d(self._plotter.ki2svg),
+                transform="translate({} {}) rotate({})".format(
+                    position[0], position[1], -hole.orientation.AsDegrees()))
 
     def _process_baselayer(self, name: str, source_filename: str) -> None:
         clipPath = self._plotter.get_def_slot(tag_name="clipPath", id="cut-off")
@@ -737,11 +799,11 @@ class PlotSubstrate(PlotInterface):
         container = etree.SubElement(mask, "g")
 
         bb = self._plotter.board.ComputeBoundingBox()
-        bg = etree.SubElement(container, "rect", x="0", y="0", fill="white")
-        bg.attrib["x"] = str(self._plotter.ki2svg(bb.GetX()))
-        bg.attrib["y"] = str(self._plotter.ki2svg(bb.GetY()))
-        bg.attrib["width"] = str(self._plotter.ki2svg(bb.GetWidth()))
-        bg.attrib["height"] = str(self._plotter.ki2svg(bb.GetHeight()))
+        bg = etree.SubElement(container, "rect", fill="white",
+            x=str(self._plotter.ki2svg(bb.GetX())),
+            y=str(self._plotter.ki2svg(bb.GetY())),
+            width=str(self._plotter.ki2svg(bb.GetWidth())),
+            height=str(self._plotter.ki2svg(bb.GetHeight())))
 
         for hole in collect_holes(self._plotter.board):
             position = list(map(self._plotter.ki2svg, hole.position))
@@ -755,13 +817,14 @@ class PlotSubstrate(PlotInterface):
                     stroke = size[1]
                     length = size[0] - size[1]
                     points = "{} {} {} {}".format(-length / 2, 0, length / 2, 0)
-                el = etree.SubElement(container, "polyline")
-                el.attrib["stroke-linecap"] = "round"
-                el.attrib["stroke"] = "black"
-                el.attrib["stroke-width"] = str(stroke)
-                el.attrib["points"] = points
-                el.attrib["transform"] = "translate({} {}) rotate({})".format(
-                    position[0], position[1], -hole.orientation.AsDegrees())
+                etree.SubElement(container, "polyline", attrib={
+                    "stroke-linecap": "round",
+                    "stroke": "black",
+                    "stroke-width": str(stroke),
+                    "points": points,
+                    "transform": "translate({} {}) rotate({})".format(
+                        position[0], position[1], -hole.orientation.AsDegrees())
+                })
 
 @dataclass
 class PlacedComponentInfo:
@@ -782,20 +845,32 @@ class PlotComponents(PlotInterface):
         self._plotter = plotter
         self._prefix = plotter.unique_prefix()
         self._used_components: Dict[str, PlacedComponentInfo] = {}
-        plotter.walk_components(invert_side=False, callback=self._append_component)
-        plotter.walk_components(invert_side=True, callback=self._append_back_component)
+        self._is_resistor: Dict[Tuple[str, str], bool] = {} # (lib, name) -> has color bands
+        # Parsing of the footprint SVGs dominates the rendering, so we first
+        # collect the distinct components and parse them in parallel. Then we
+        # place them sequentially.
+        self._svg_trees: Dict[str, Future[Tuple[etree.Element, str]]] = {}
+        # Footprints shared by multiple values (e.g., resistors) are read only
+        # once, each instance is then parsed from the cached content
+        self._svg_sources: Dict[str, Future[Tuple[str, List[str]]]] = {}
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            self._executor = executor
+            plotter.walk_components(invert_side=False, callback=self._prefetch_component)
+            plotter.walk_components(invert_side=True, callback=self._prefetch_back_component)
+            plotter.walk_components(invert_side=False, callback=self._append_component)
+            plotter.walk_components(invert_side=True, callback=self._append_back_component)
 
     def _get_unique_name(self, lib: str, name: str, value: str) -> str:
         return f"{self._prefix}_{lib}__{name}_{value}"
 
-    def _append_back_component(self, lib: str, name: str, ref: str, value: str,
-                          position: Tuple[int, int, float]) -> None:
-        return self._append_component(lib, name + ".back", ref, value, position)
-
-    def _append_component(self, lib: str, name: str, ref: str, value: str,
-                          position: Tuple[int, int, float]) -> None:
+    def _resolve_component(self, lib: str, name: str, ref: str, value: str) \
+            -> Optional[Tuple[str, str, str]]:
+        """
+        Apply filtering, value overrides and remapping to a component. Return
+        the final lib, name and value or None if the component is not shown.
+        """
         if not self.filter(ref) or name == "":
-            return
+            return None
         # Override resistor values
         if ref in self.resistor_values:
             v = self.resistor_values[ref].value
@@ -803,47 +878,98 @@ class PlotComponents(PlotInterface):
                 value = v
 
         lib, name = self.remapping(ref, lib, name)
+        return lib, name, value
+
+    def _prefetch_back_component(self, lib: str, name: str, ref: str, value: str,
+                                 position: Tuple[int, int, float]) -> None:
+        return self._prefetch_component(lib, name + ".back", ref, value, position)
+
+    def _prefetch_component(self, lib: str, name: str, ref: str, value: str,
+                            position: Tuple[int, int, float]) -> None:
+        resolved = self._resolve_component(lib, name, ref, value)
+        if resolved is None:
+            return
+        lib, name, value = resolved
+        unique_name = self._get_unique_name(lib, name, value)
+        if unique_name in self._svg_trees:
+            return
+        f = self._plotter._get_model_file(lib, name)
+        if f is None:
+            return
+        if f not in self._svg_sources:
+            self._svg_sources[f] = self._executor.submit(read_svg_source, f)
+        # The prefix is taken here, on the main thread, in the same order the
+        # components are placed. The source task is queued before the
+        # instance task, so waiting for it within the pool cannot deadlock.
+        self._svg_trees[unique_name] = self._executor.submit(
+            self._instantiate_svg, self._svg_sources[f], self._plotter.unique_prefix())
+
+    @staticmethod
+    def _instantiate_svg(source: Future[Tuple[str, List[str]]], prefix: str) \
+            -> Tuple[etree.Element, str]:
+        content, ids = source.result()
+        return make_svg_unique(content, ids, prefix), prefix
+
+    def _append_back_component(self, lib: str, name: str, ref: str, value: str,
+                          position: Tuple[int, int, float]) -> None:
+        return self._append_component(lib, name + ".back", ref, value, position)
+
+    def _append_component(self, lib: str, name: str, ref: str, value: str,
+                          position: Tuple[int, int, float]) -> None:
+        resolved = self._resolve_component(lib, name, ref, value)
+        if resolved is None:
+            return
+        lib, name, value = resolved
 
         unique_name = self._get_unique_name(lib, name, value)
         if unique_name in self._used_components:
+            # The definition is already placed, so we can attach the
+            # transformation directly to the use element; no wrapping group
+            # is needed
             component_info = self._used_components[unique_name]
-            component_element = etree.Element("use",
-                attrib={"{http://www.w3.org/1999/xlink}href": "#" + component_info.id})
+            component_element = etree.Element(_USE_TAG, {
+                _XLINK_HREF: "#" + component_info.id,
+                "transform": self._component_transform(component_info, position)
+            })
         else:
             ret = self._create_component(lib, name, ref, value)
             if ret is None:
                 self._plotter.yield_warning("component", f"Component {lib}:{name} has no footprint.")
                 return
-            component_element, component_info = ret
+            definition, component_info = ret
             self._used_components[unique_name] = component_info
+            component_element = etree.Element(_G_TAG, {
+                "transform": self._component_transform(component_info, position)
+            })
+            component_element.append(definition)
 
         self._plotter.append_component_element(etree.Comment(f"{lib}:{name}:{ref}"))
-        group = etree.Element("g")
-        group.append(component_element)
-        ci = component_info
-        group.attrib["transform"] = \
-            f"translate({self._plotter.ki2svg(position[0])} {self._plotter.ki2svg(position[1])}) " + \
-            f"scale({ci.scale[0]}, {ci.scale[1]}) " + \
-            f"rotate({-math.degrees(position[2])}) " + \
-            f"translate({-ci.origin[0]} {-ci.origin[1]})"
-        self._plotter.append_component_element(group)
+        self._plotter.append_component_element(component_element)
 
         if self.highlight(ref):
             self._build_highlight(ref, component_info, position)
 
+    def _component_transform(self, ci: PlacedComponentInfo,
+                             position: Tuple[int, int, float]) -> str:
+        return f"translate({self._plotter.ki2svg(position[0])} {self._plotter.ki2svg(position[1])}) " + \
+               f"scale({ci.scale[0]}, {ci.scale[1]}) " + \
+               f"rotate({-math.degrees(position[2])}) " + \
+               f"translate({-ci.origin[0]} {-ci.origin[1]})"
+
     def _create_component(self, lib: str, name: str, ref: str, value: str) \
                              -> Optional[Tuple[etree.Element, PlacedComponentInfo]]:
-        f = self._plotter._get_model_file(lib, name)
-        if f is None:
-            return None
-        xml_id = make_XML_identifier(self._get_unique_name(lib, name, value))
-        component_element = etree.Element("g", attrib={"id": xml_id})
-
-        svg_tree, id_prefix = read_svg_unique2(f, self._plotter.unique_prefix())
-        for x in extract_svg_content(svg_tree):
-            if x.tag in ["namedview", "metadata"]:
-                continue
-            component_element.append(x)
+        unique_name = self._get_unique_name(lib, name, value)
+        if unique_name in self._svg_trees:
+            svg_tree, id_prefix = self._svg_trees.pop(unique_name).result()
+        else:
+            f = self._plotter._get_model_file(lib, name)
+            if f is None:
+                return None
+            svg_tree, id_prefix = read_svg_unique2(f, self._plotter.unique_prefix())
+        xml_id = make_XML_identifier(unique_name)
+        component_element = etree.Element(_G_TAG, {"id": xml_id})
+
+        component_element.extend(extract_svg_content(svg_tree, skip=SVG_EDITOR_TAGS))
         origin_x: Numeric = 0
         origin_y: Numeric = 0
         origin = component_element.find(".//*[@id='origin']")
@@ -852,50 +978,64 @@ class PlotComponents(PlotInterface):
             origin.getparent().remove(origin)
         else:
             self._plotter.yield_warning("origin", f"component: Component {lib}:{name} has not origin")
-        svg_scale_x, svg_scale_y, svg_offset_x, svg_offset_y = self._component_to_board_scale_and_offset(svg_tree)
+        size = (to_kicad_basic_units(svg_tree.attrib["width"]),
+                to_kicad_basic_units(svg_tree.attrib["height"]))
+        svg_scale_x, svg_scale_y, svg_offset_x, svg_offset_y = \
+            self._component_to_board_scale_and_offset(svg_tree, size)
         component_info = PlacedComponentInfo(
             id=xml_id,
             origin=(origin_x, origin_y),
             svg_offset=(svg_offset_x, svg_offset_y),
             scale=(svg_scale_x, svg_scale_y),
-            size=(to_kicad_basic_units(svg_tree.attrib["width"]), to_kicad_basic_units(svg_tree.attrib["height"]))
+            size=size
         )
-        self._apply_resistor_code(component_element, id_prefix, ref, value)
+        is_resistor = self._is_resistor.get((lib, name))
+        if is_resistor is None:
+            is_resistor = component_element.find(f".//*[@id='{id_prefix}res_band1']") is not None
+            self._is_resistor[(lib, name)] = is_resistor
+        if is_resistor:
+            self._apply_resistor_code(component_element, id_prefix, ref, value)
         return component_element, component_info
 
-    def _component_to_board_scale_and_offset(self, svg: etree.Element) \
+    def _component_to_board_scale_and_offset(self, svg: etree.Element,
+                                             size: Tuple[int, int]) \
             -> Tuple[float, float, float, float]:
-        width = self._plotter.ki2svg(to_kicad_basic_units(svg.attrib["width"]))
-        height = self._plotter.ki2svg(to_kicad_basic_units(svg.attrib["height"]))
+        """
+        Given the component SVG and its size in KiCAD units, return the scale
+        and offset of the SVG to the board coordinates.
+        """
+        width = self._plotter.ki2svg(size[0])
+        height = self._plotter.ki2svg(size[1])
         x, y, vw, vh = [float(x) for x in svg.attrib["viewBox"].split()]
         return width / vw, height / vh, x, y
 
     def _build_highlight(self, ref: str, info: PlacedComponentInfo,
                          position: Tuple[int, int, float]) -> None:
         padding = mm2ki(self._plotter.get_style("highlight-padding"))
-        h = etree.Element("rect", id=f"h_{ref}",
+        h = etree.Element(_RECT_TAG, id=f"h_{ref}",
             x=str(self._plotter.ki2svg(-padding)),
             y=str(self._plotter.ki2svg(-padding)),
             width=str(self._plotter.ki2svg(int(info.size[0] + 2 * padding))),
             height=str(self._plotter.ki2svg(int(info.size[1] + 2 * padding))),
-            style=self._plotter.get_style("highlight-style"))
-        h.attrib["transform"] = \
-            f"translate({self._plotter.ki2svg(position[0])} {self._plotter.ki2svg(position[1])}) " + \
-            f"rotate({-math.degrees(position[2])}) " + \
-            f"translate({-(info.origin[0] - info.svg_offset[0]) * info.scale[0]}, {-(info.origin[1] - info.svg_offset[1]) * info.scale[1]})"
+            style=self._plotter.get_style("highlight-style"),
+            transform=
+                f"translate({self._plotter.ki2svg(position[0])} {self._plotter.ki2svg(position[1])}) " + \
+                f"rotate({-math.degrees(position[2])}) " + \
+                f"translate({-(info.origin[0] - info.svg_offset[0]) * info.scale[0]}, {-(info.origin[1] - info.svg_offset[1]) * info.scale[1]})")
         self._plotter.append_highlight_element(h)
 
     def _apply_resistor_code(self, root: etree.Element, id_prefix: str, ref: str, value: str) -> None:
-        if root.find(f".//*[@id='{id_prefix}res_band1']") is None:
-            return
+        """
+        Color the resistor bands of the component. The root is expected to
+        contain the bands; see _create_component.
+        """
         try:
             res, tolerance = self._get_resistance_from_value(value)
-            power = math.floor(res.log10()) - 1
-            res = Decimal(int(float(res) / 10 ** power))
+            first, second, power = resistor_bands(res)
             resistor_colors = [
-                self._plotter.get_style("tht-resistor-band-colors", int(str(res)[0])),
-                self._plotter.get_style("tht-resistor-band-colors", int(str(res)[1])),
-                self._plotter.get_style("tht-resistor-band-colors", int(power)),
+                self._plotter.get_style("tht-resistor-band-colors", first),
+                self._plotter.get_style("tht-resistor-band-colors", second),
+                self._plotter.get_style("tht-resistor-band-colors", power),
                 self._plotter.get_style("tht-resistor-band-colors", tolerance)
             ]
 
@@ -952,7 +1092,7 @@ class PlotPlaceholders(PlotInterface):
 
     def _append_placeholder(self, lib: str, name: str, ref: str, value: str,
                           position: Tuple[int, int, float]) -> None:
-        p = etree.Element("rect",
+        p = etree.Element(_RECT_TAG,
             x=str(self._plotter.ki2svg(position[0] - mm2ki(0.5))),
             y=str(self._plotter.ki2svg(position[1] - mm2ki(0.5))),
             width=str(self._plotter.ki2svg(mm2ki(1))), height=str(self._plotter.ki2svg(mm2ki(1))), style="fill:red;")
@@ -1022,10 +1162,13 @@ class PcbPlotter():
         self.data_path: List[str] = [] # Base paths for libraries lookup
         self.libs: List[str] = [] # Names of available libraries
         self._libs_path: List[str] = []
+        self._model_files: Dict[Tuple[str, str], Optional[str]] = {} # Lookup cache for _get_model_file
         self._svg_precision = 6 # The SVG precision for KiCAD 6 plotting
         self._svg_divider = 1
 
         self.style: Any = {}     # Color scheme
+        # Flattened style and the default one, valid only during plot()
+        self._flat_style: Optional[Dict[Tuple[Union[str, int], ...], Any]] = None
         self.margin: int = 0 # Margin of the resulting document
 
         self.yield_warning: Callable[[str, str], None] = lambda tag, msg: None # Handle warnings
@@ -1060,10 +1203,19 @@ class PcbPlotter():
         Plot the board based on the arguments stored in this class. Returns
         SVG tree that you can either save or post-process as you wish.
         """
-        self._build_libs_path()
-        self._setup_document(self.render_back, self.mirror)
-        for plotter in self.plot_plan:
-            plotter.render(self)
+        # The style is flattened together with the default one for each plot,
+        # so get_style is a single lookup and callers can still modify the
+        # style in place between plots
+        self._flat_style = {}
+        flatten_style(self.style, (), self._flat_style)
+        flatten_style(default_style, (), self._flat_style)
+        try:
+            self._build_libs_path()
+            self._setup_document(self.render_back, self.mirror)
+            for plotter in self.plot_plan:
+                plotter.render(self)
+        finally:
+            self._flat_style = None
         remove_empty_elems(self._document.getroot())
         remove_inkscape_annotation(self._document.getroot())
         self._shrink_svg(self._document, self.margin)
@@ -1164,38 +1316,48 @@ class PcbPlotter():
         return find_data_file(name, extension, self.data_path, subdir)
 
     def _build_libs_path(self) -> None:
-        self._libs_path = []
-        for l in self.libs:
-            self._libs_path += [os.path.join(p, l) for p in self.data_path]
-        for l in self.libs:
-            self._libs_path += [os.path.join(p, "footprints", l) for p in self.data_path]
-        self._libs_path = [x for x in self._libs_path if os.path.exists(x)]
+        # Libraries placed directly in the data paths take precedence over
+        # the ones in the footprints subdirectory
+        self._libs_path = [os.path.join(p, *subdir, l)
+            for subdir in [(), ("footprints",)]
+            for l in self.libs
+            for p in self.data_path]
+        self._libs_path = [x for x in self._libs_path if os.path.isdir(x)]
+        self._model_files = {}
 
     def _get_model_file(self, lib: str, name: str) -> Optional[str]:
         """
         Find model file in the configured libraries. If it doesn't exists,
         return None.
         """
+        key = (lib, name)
+        if key in self._model_files:
+            return self._model_files[key]
+        model_file = None
         for path in self._libs_path:
             f = os.path.join(path, lib, name + ".svg")
             if os.path.isfile(f):
-                return f
-        return None
+                model_file = f
+                break
+        self._model_files[key] = model_file
+        return model_file
 
     def get_style(self, *args: Union[str, int]) -> Any:
-        try:
-            value = self.style
-            for key in args:
-                value = value[key]
-            return value
-        except KeyError:
+        if self._flat_style is not None:
+            try:
+                return self._flat_style[args]
+            except KeyError:
+                pass
+        # Outside of plot, or for values not reachable through nested dicts
+        for style in [self.style, default_style]:
             try:
-                value = default_style
+                value = style
                 for key in args:
                     value = value[key]
                 return value
-            except KeyError as e:
-                raise UserWarning(f"Invalid argument for get_style : {args[0]}, {args[1]}")
+            except KeyError:
+                continue
+        raise UserWarning(f"Invalid argument for get_style : {', '.join(map(str, args))}")
 
     def execute_plot_plan(self, to_plot: List[PlotAction]) -> None:
         """
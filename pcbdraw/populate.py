@@ -1,58 +1,57 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import codecs
+import mmap
 import os
 import re
 import shlex
 import sys
-from copy import deepcopy
-from itertools import chain
-from typing import List, Optional, Any, Tuple, Dict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Any, Sequence, TextIO, Tuple, Dict
 
 import click
-import pybars # type: ignore
-import yaml
 
-import pcbdraw.mdrenderer
-
-from .mistune_shim import mistune  # type: ignore
-from .mistune_shim import (HTMLRenderer, InlineParser, plugin_footnotes, plugin_table) # type: ignore
+# Mistune, pybars and YAML are imported only when they are needed, since
+# this module is loaded also by the plot command via pcbdraw.ui
+from .handlebars_shim import compile_template
 from .pcbnew_common import fakeKiCADGui
+from pcbnewTransition import pcbnew # type: ignore
 from .plot import find_data_file, get_global_datapaths
 
 PKG_BASE = os.path.dirname(__file__)
 
+# Terminator of the YAML header, a line "..."
+HEADER_END_RE = re.compile(rb"\n\.\.\.\r*(?:\n|\Z)")
+
+# Inline syntax [[side | components]] marking the components of a step
+PCBDRAW_PATTERN = (
+    r"\[\["                   # [[
+    r"([\s\S]+?\|[\s\S]+?)"   # side| component
+    r"\]\](?!\])"             # ]]
+)
+
 def parse_pcbdraw(lexer: Any, m: re.Match[str], state: Any=None) -> Any:
     text = m.group(1)
     side, components = text.split("|")
     components = list(map(lambda x: x.strip(), components.split(",")))
     return 'pcbdraw', side, components
 
-class PcbDrawInlineLexer(InlineParser): # type: ignore
-    def __init__(self, renderer: Any, **kwargs: Any) -> None:
-        super(PcbDrawInlineLexer, self).__init__(renderer, **kwargs)
-        self.enable_pcbdraw()
-
-    def enable_pcbdraw(self) -> None:
-        pcbdraw_pattern = (
-            r"\[\["                   # [[
-            r"([\s\S]+?\|[\s\S]+?)"   # side| component
-            r"\]\](?!\])"             # ]]
-        )
-        if hasattr(self, 'register_rule'):
-            # mistune v2 API
-            self.rules.insert(3, 'pcbdraw')
-            self.register_rule('pcbdraw', pcbdraw_pattern, parse_pcbdraw)
-        else:
-            # mistune v0.8.4
-            self.rules.pcbdraw = re.compile(pcbdraw_pattern)
-            self.default_rules.insert(3, 'pcbdraw')
+def PcbDrawInlineLexer(renderer: Any, **kwargs: Any) -> Any:
+    from .mistune_shim import InlineParser # type: ignore
 
-    # This method is invoked by the old mistune API (i.e. v0.8.4)
-    # For the new API we register `parse_pcbdraw`
-    def output_pcbdraw(self, m: re.Match[str]) -> Any:
-        _, side, components = parse_pcbdraw(self, m)
-        return self.renderer.pcbdraw(side, components)
+    class Tmp(InlineParser): # type: ignore
+        def __init__(self, renderer: Any, **kwargs: Any) -> None:
+            super(Tmp, self).__init__(renderer, **kwargs)
+            self.enable_pcbdraw()
+
+        def enable_pcbdraw(self) -> None:
+            # Mistune combines all the registered inline rules into a single
+            # alternation and scans the text via finditer, so registering the
+            # rule is all we have to do.
+            self.rules.insert(3, 'pcbdraw')
+            self.register_rule('pcbdraw', PCBDRAW_PATTERN, parse_pcbdraw)
+    return Tmp(renderer, **kwargs)
 
 
 def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
@@ -62,8 +61,14 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
             self.items: List[Dict[str, Any]]= []
             self.current_item: Optional[Dict[str, Any]] = None
             self.active_side: str = "front"
-            self.visited_components: List[str] = initial_components
+            # Ordered set of the visited components; a component mentioned in
+            # several steps is stored only once
+            self._visited: Dict[str, None] = dict.fromkeys(initial_components)
             self.active_components: List[str] = []
+            # Steps share a snapshot of the visited components taken at the
+            # last pcbdraw mark, so we don't have to copy it for every step
+            self._visited_snapshot: List[str] = list(self._visited)
+            self._comment_parts: List[str] = []
 
         def append_comment(self, html: str) -> None:
             if self.current_item is not None and self.current_item["type"] == "steps":
@@ -74,10 +79,13 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
                     "type": "comment",
                     "content": ""
                 }
-            self.current_item["content"] += html
+                self._comment_parts = []
+            # The content is joined once the comment is finished
+            self._comment_parts.append(html)
 
         def append_step(self, step: Dict[str, Any]) -> None:
             if self.current_item is not None and self.current_item["type"] == "comment":
+                self._flush_comment()
                 self.items.append(self.current_item)
             if self.current_item is None or self.current_item["type"] == "comment":
                 self.current_item = {
@@ -87,16 +95,23 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
                 }
             self.current_item["steps"].append(step)
 
+        def _flush_comment(self) -> None:
+            assert self.current_item is not None
+            self.current_item["content"] = "".join(self._comment_parts)
+
         def output(self) -> List[Dict[str, Any]]:
             items = self.items
             if self.current_item is not None:
+                if self.current_item["type"] == "comment":
+                    self._flush_comment()
                 items.append(self.current_item)
             return items
 
         def pcbdraw(self, side: str, components: List[str]) -> str:
             self.active_side = side
-            self.visited_components += components
+            self._visited.update(dict.fromkeys(components))
             self.active_components = components
+            self._visited_snapshot = list(self._visited)
             return ""
 
         def block_code(self, children: str, info: Optional[str]=None) -> Any:
@@ -119,18 +134,6 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
             self.append_comment(retval)
             return retval
 
-        # Mistune 0.8.4 API
-        def header(self, text: str, level: int, raw: Optional[str]=None) -> Any:
-            retval = super(Tmp, self).header(text, level, raw)
-            self.append_comment(retval)
-            return retval
-
-        # Mistune 0.8.4 API
-        def hrule(self) -> Any:
-            retval = super(Tmp, self).hrule()
-            self.append_comment(retval)
-            return retval
-
         def thematic_break(self) -> Any:
             retval = super(Tmp, self).thematic_break()
             self.append_comment(retval)
@@ -142,11 +145,11 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
         def list_item(self, text: str, level: Any=None) -> str:
             step = {
                 "side": self.active_side,
-                "components": self.visited_components,
+                "components": self._visited_snapshot,
                 "active_components": self.active_components,
                 "comment": text
             }
-            self.append_step(deepcopy(step))
+            self.append_step(step)
             return ""
 
         def paragraph(self, text: str) -> Any:
@@ -161,17 +164,33 @@ def Renderer(BaseRenderer, initial_components: List[str]): # type: ignore
     return Tmp(initial_components)
 
 def load_content(filename: str) -> Tuple[Optional[Dict[str, Any]], str]:
-    header = None
-    with codecs.open(filename, encoding="utf-8") as f:
-        content = f.read()
-        if content.startswith("---"):
-            end = content.find("...")
-            if end != -1:
-                header = yaml.safe_load(content[3:end])
-                content = content[end+3:]
-    return header, content
+    """
+    Read the source file and split it into the YAML header and the markdown
+    content. The header starts with "---" and ends with a line "...".
+    """
+    import yaml
+
+    # Prefer the libyaml-backed loader when it is available
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    # The file is memory-mapped, so the body is decoded straight from the
+    # mapping without reading it into an intermediate bytes object. The
+    # header is passed to the YAML loader without decoding.
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None, ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+             memoryview(mm) as view:
+            header_end = None
+            if mm[:3] == b"---":
+                header_end = HEADER_END_RE.search(mm, 3)
+            if header_end is None:
+                return None, codecs.decode(view, "utf-8")
+            header = yaml.load(mm[3:header_end.start() + 1], Loader=loader)
+            return header, codecs.decode(view[header_end.end():], "utf-8")
 
 def parse_content(renderer: Any, content: str) -> List[Dict[str, Any]]:
+    from .mistune_shim import mistune, plugin_footnotes, plugin_table # type: ignore
+
     lexer = PcbDrawInlineLexer(renderer)
     processor = mistune.Markdown(renderer=renderer, inline=lexer)
     plugin_table(processor)
@@ -183,71 +202,114 @@ def read_template(filename: str) -> str:
     with codecs.open(filename, encoding="utf-8") as f:
         return f.read()
 
-def generate_html(template: str, input: List[Dict[str, Any]]) -> bytes:
+def generate_html(template: str, input: List[Dict[str, Any]], out: TextIO) -> None:
     input_dict = {
         "items": input
     }
-    template_fn = pybars.Compiler().compile(template)
-    return template_fn(input_dict).encode("utf-8") # type: ignore
+    template_fn = compile_template(template)
+    out.writelines(template_fn(input_dict))
 
-def generate_markdown(input: List[Dict[str, Any]]) -> bytes:
-    output = ""
+def generate_markdown(input: List[Dict[str, Any]], out: TextIO) -> None:
     for item in input:
         if item["type"] == "comment":
-            output += item["content"] + "\n"
+            out.write(item["content"] + "\n")
         else:
             for x in item["steps"]:
-                output += "#### " + x["comment"] + "\n\n"
-                output += "![step](" + x["img"] + ")\n\n"
-    return output.encode("utf-8")
+                out.write(f"#### {x['comment']}\n\n![step]({x['img']})\n\n")
 
 
 def generate_images(content: List[Dict[str, Any]], boardfilename: str,
-                    plot_args: List[str], name: str, outdir: str) -> List[Dict[str, Any]]:
-    dir = os.path.dirname(os.path.join(outdir, name))
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-    counter = 0
-    for item in content:
-        if item["type"] != "steps":
-            continue
-        for x in item["steps"]:
-            counter += 1
-            filename = name.format(counter)
-            generate_image(boardfilename, x["side"], x["components"],
-                x["active_components"], plot_args, os.path.join(outdir, filename))
-            x["img"] = filename
+                    plot_args: List[str], name: str, outdir: str,
+                    jobs: Optional[int]=None) -> List[Dict[str, Any]]:
+    """
+    Generate images for all steps. The steps are independent, so they are
+    rendered by a pool of jobs processes (CPU count if not specified).
+    """
+    os.makedirs(os.path.dirname(os.path.join(outdir, name)), exist_ok=True)
+    # Equivalent to os.path.join(outdir, filename) for each of the filenames
+    prefix = "" if os.path.isabs(name) else os.path.join(outdir, "")
+    steps = [x for item in content if item["type"] == "steps" for x in item["steps"]]
+    filenames = format_image_names(name, len(steps))
+    if len(steps) == 0:
+        return content
+    # The plot parameters are shared by all the steps, so we parse them just
+    # once; the steps override only the side, filter and highlight
+    params = parse_plot_params(plot_args, boardfilename, prefix + filenames[0])
+    tasks = [(boardfilename, x["side"], x["components"], x["active_components"],
+              params, prefix + filename)
+             for x, filename in zip(steps, filenames)]
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            generate_image(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # Consume the results to propagate exceptions
+            list(executor.map(generate_image, *zip(*tasks)))
+    for x, filename in zip(steps, filenames):
+        x["img"] = filename
     return content
 
-def generate_image(boardfilename: str, side: str, components: List[str],
-                   active: List[str], plot_args: List[str], outputfile: str) -> None:
-    from copy import deepcopy
-
+def format_image_names(name: str, count: int) -> List[str]:
+    """
+    Return image names for steps 1 to count given the name template
+    """
+    # The common case of a single plain placeholder is split just once instead
+    # of parsing the format string for every step
+    prefix, placeholder, suffix = name.partition("{}")
+    if placeholder and not any(c in prefix + suffix for c in "{}"):
+        return [f"{prefix}{counter}{suffix}" for counter in range(1, count + 1)]
+    return [name.format(counter) for counter in range(1, count + 1)]
+
+def parse_plot_params(plot_args: Sequence[str], boardfilename: str,
+                      outputfile: str) -> Dict[str, Any]:
+    """
+    Parse the plot command line into keyword arguments of plot_board
+    """
+    # The import cannot be at the module level as pcbdraw.ui imports this
+    # module
     from .ui import plot
 
-    plot_args = deepcopy(plot_args)
+    try:
+        return plot.make_context("plot", [*plot_args, boardfilename, outputfile]).params
+    except click.ClickException as e:
+        e.show()
+        sys.exit(e.exit_code)
 
+def generate_image(boardfilename: str, side: str, components: List[str],
+                   active: List[str], plot_params: Dict[str, Any], outputfile: str) -> None:
+    from .ui import plot_board
+
+    params = dict(plot_params)
     if side.startswith("back"):
-        plot_args += ["--side", "back"]
-    plot_args += ["--filter", ",".join(components)]
-    plot_args += ["--highlight", ",".join(active)]
-    plot_args += [boardfilename, outputfile]
+        params["side"] = "back"
+    params["filter"] = components
+    params["highlight"] = active
+    # Parsing the board is expensive, reuse it for all the steps
+    params["input"] = load_board(boardfilename)
+    params["output"] = outputfile
     try:
-        plot.main(args=plot_args)
+        plot_board(**params)
     except SystemExit as e:
         if e.code is not None and e.code != 0:
             raise e from None
 
+def load_board(boardfilename: str) -> pcbnew.BOARD:
+    # The modification time is a part of the cache key, so a board edited
+    # between two runs in the same process (or before forking the workers) is
+    # loaded again
+    return _load_board(boardfilename, os.path.getmtime(boardfilename))
+
+@lru_cache(maxsize=1)
+def _load_board(boardfilename: str, mtime: float) -> pcbnew.BOARD:
+    return pcbnew.LoadBoard(boardfilename)
+
 def get_data_path() -> List[str]:
-    paths: List[str] = []
-    paths += filter(lambda x: len(x) > 0, os.environ.get("PCBDRAW_LIB_PATH", "").split(":"))
-    paths += [os.path.join(PKG_BASE, "resources")]
-    paths += get_global_datapaths()
-    return paths
+    return [*filter(lambda x: len(x) > 0, os.environ.get("PCBDRAW_LIB_PATH", "").split(":")),
+            os.path.join(PKG_BASE, "resources"),
+            *get_global_datapaths()]
 
 def prepare_params(params: List[str]) -> List[str]:
-    p = [shlex.split(x) for x in params]
-    return list(chain(*p))
+    return [token for x in params for token in shlex.split(x)]
 
 @click.command()
 @click.argument("input", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -260,8 +322,10 @@ def prepare_params(params: List[str]) -> List[str]:
     help="override handlebars template for HTML output")
 @click.option("--type", "-t", type=click.Choice(["md", "html"]), default=None,
     help="override output type: markdown or HTML")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=None,
+    help="number of images rendered in parallel, defaults to the number of CPUs")
 def populate(input: str, output: str, board: Optional[str], imgname: Optional[str],
-             template: Optional[str], type: Optional[str]) -> None:
+             template: Optional[str], type: Optional[str], jobs: Optional[int]) -> None:
     """
     Create assembly step-by-step guides
     """
@@ -280,57 +344,70 @@ def populate(input: str, output: str, board: Optional[str], imgname: Optional[st
         board = os.path.realpath(board)
     outputpath = os.path.realpath(output)
     input_dir = os.path.dirname(input)
+    # The plot parameters in the header (e.g., styles, remapping or libraries)
+    # are resolved by the plot command relative to the working directory.
+    # Restore it once we are done so populate can be invoked repeatedly from
+    # the same process.
+    cwd = os.getcwd()
     if input_dir != '':
         os.chdir(input_dir)
-
-    # If no overriding is specified, load it from the template
     try:
-        if board is None:
-            if header is None:
-                raise KeyError("board")
-            board = header["board"]
-        if imgname is None:
-            if header is None:
-                raise KeyError("imgname")
-            imgname = header["imgname"]
-        if type is None:
-            if header is None:
-                raise KeyError("type")
-            type = header["type"]
-        if template is None and type == "html":
-            if header is None:
-                raise KeyError("template")
-            template = header["template"]
-    except KeyError as e:
-        sys.exit(f"Missing parameter {e} either in template file or source header")
-
-    if type == "html":
-        renderer = Renderer(HTMLRenderer, header.get("initial_components", [])) # type: ignore
-        outputfile = "index.html"
+        # If no overriding is specified, load it from the template
         try:
-            assert template is not None
-            template_file = find_data_file(template, '.handlebars', data_path, "templates")
-            if template_file is None:
-                raise RuntimeError(f"Cannot find template '{template}'")
-            template = read_template(template_file)
-        except IOError:
-            sys.exit("Cannot open template file " + str(template))
-    else:
-        renderer = Renderer(pcbdraw.mdrenderer.MdRenderer, header.get("initial_components", [])) # type: ignore
-        outputfile = "index.md"
-    parsed_content = parse_content(renderer, content)
-    if header is None:
-        raise RuntimeError("Parameters were not specified in the template")
-    parsed_content = generate_images(parsed_content, board, prepare_params(header["params"]),
-                                     imgname, outputpath)
-    if type == "html":
-        assert template is not None
-        output_content = generate_html(template, parsed_content)
-    else:
-        output_content = generate_markdown(parsed_content)
+            if board is None:
+                if header is None:
+                    raise KeyError("board")
+                board = header["board"]
+            if imgname is None:
+                if header is None:
+                    raise KeyError("imgname")
+                imgname = header["imgname"]
+            if type is None:
+                if header is None:
+                    raise KeyError("type")
+                type = header["type"]
+            if template is None and type == "html":
+                if header is None:
+                    raise KeyError("template")
+                template = header["template"]
+        except KeyError as e:
+            sys.exit(f"Missing parameter {e} either in template file or source header")
+        # The loaded board is cached by its path, so the path has to be
+        # absolute to stay unique across invocations
+        board = os.path.realpath(board)
+
+        if type == "html":
+            from .mistune_shim import HTMLRenderer # type: ignore
+            renderer = Renderer(HTMLRenderer, header.get("initial_components", [])) # type: ignore
+            outputfile = "index.html"
+            try:
+                assert template is not None
+                template_file = find_data_file(template, '.handlebars', data_path, "templates")
+                if template_file is None:
+                    raise RuntimeError(f"Cannot find template '{template}'")
+                template = read_template(template_file)
+            except IOError:
+                sys.exit("Cannot open template file " + str(template))
+        else:
+            from .mdrenderer import MdRenderer
+            renderer = Renderer(MdRenderer, header.get("initial_components", [])) # type: ignore
+            outputfile = "index.md"
+        parsed_content = parse_content(renderer, content)
+        if header is None:
+            raise RuntimeError("Parameters were not specified in the template")
+        parsed_content = generate_images(parsed_content, board, prepare_params(header["params"]),
+                                         imgname, outputpath, jobs)
+        # The output is written as it is rendered; newline="" keeps the line
+        # endings of the template untouched
+        with open(os.path.join(outputpath, outputfile), "w", encoding="utf-8", newline="") as f:
+            if type == "html":
+                assert template is not None
+                generate_html(template, parsed_content, f)
+            else:
+                generate_markdown(parsed_content, f)
+    finally:
+        os.chdir(cwd)
 
-    with open(os.path.join(outputpath, outputfile), "wb") as f:
-        f.write(output_content)
 
 if __name__ == '__main__':
     populate()
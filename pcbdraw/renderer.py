@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 import contextlib
+import hashlib
 import json
 import os
+import re
 import shutil
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from tempfile import TemporaryDirectory
@@ -21,9 +24,16 @@ try:
 except ImportError:
     pass
 
-from PIL import Image, ImageChops, ImageDraw, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
 from pyvirtualdisplay.smartdisplay import SmartDisplay
 
+# mss grabs the screen via shared memory, which is much faster than grabbing
+# it via pyvirtualdisplay. It is optional; we fallback to pyvirtualdisplay.
+try:
+    import mss # type: ignore
+except ImportError:
+    mss = None
+
 from .pcbnew_common import findBoardBoundingBox
 from pcbnewTransition import pcbnew, getVersion # type: ignore
 
@@ -57,6 +67,12 @@ class PcbnewSession:
         self._display = display
         self._process = pcbnewProcess
         self._configdir = configdir
+        # Multiple sessions can run concurrently, so we never rely on the
+        # global DISPLAY variable
+        self._env = dict(os.environ, DISPLAY=display.new_display_var)
+        self._grabber = None
+        if mss is not None:
+            self._grabber = mss.mss(display=display.new_display_var)
 
         if DEBUG_PATH is not None:
             from pathlib import Path
@@ -74,10 +90,26 @@ class PcbnewSession:
         Run xdotool with arguments and return its output.
         """
         command = ["xdotool"] + [str(x) for x in args]
-        c = subprocess.run(command, capture_output=True)
+        c = subprocess.run(command, capture_output=True, env=self._env)
         output = c.stdout.decode("utf-8")
         return [x.strip() for x in output.split("\n") if len(x.strip())]
 
+    def _xdotoolAction(self, args: List[Any]) -> None:
+        """
+        Run xdotool with arguments that produce no interesting output, e.g.,
+        sending keys. The output is discarded without capturing it.
+        """
+        command = ["xdotool"] + [str(x) for x in args]
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, env=self._env)
+
+
+    def _windowExists(self, windowId: int) -> bool:
+        """
+        Check if the window exists. It is cheaper than listing all the windows.
+        """
+        command = ["xdotool", "getwindowname", str(windowId)]
+        return subprocess.run(command, capture_output=True, env=self._env).returncode == 0
 
     def listWindows(self) -> Dict[str, int]:
         """
@@ -104,64 +136,102 @@ class PcbnewSession:
         Waits for a window with title
         """
         titlePatterns = [x.lower() for x in titlePatterns]
-        for _ in range(timeout + 1):
+        # Let xdotool match the titles (case-insensitively) in a single call
+        # instead of querying the name of every window of the process
+        namePattern = "|".join(re.escape(x) for x in titlePatterns)
+        # Windows usually appear quickly, so we start polling fast and back
+        # off up to a poll per second
+        deadline = time.monotonic() + timeout
+        interval = 0.05
+        while True:
             if callback is not None:
                 callback()
             self.debugDump()
-            windows = self.listWindows()
-            for title, id in windows.items():
-                if any([pattern in title.lower() for pattern in titlePatterns]):
-                    return id
-            time.sleep(1)
-        windows_list = "\n".join([f"- {t}" for t in windows.keys()])
+            matches = self._xdotool(["search", "--pid", self._process.pid,
+                                     "--name", namePattern])
+            if len(matches) > 0:
+                return int(matches[0])
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(interval)
+            interval = min(2 * interval, 1)
+        windows_list = "\n".join([f"- {t}" for t in self.listWindows().keys()])
         raise TimeoutError(f"None of '{titlePatterns}' didn't appear within timeout. Available windows:\n{windows_list}")
 
     def maximizeWindow(self, windowId: int) -> None:
-        self._xdotool(["windowmove", windowId, "0", "0"])
-        self._xdotool(["windowsize", windowId, "100%", "100%"])
-        self._xdotool(["windowactivate", "--sync", windowId])
+        self._xdotoolAction(["windowmove", windowId, "0", "0"])
+        self._xdotoolAction(["windowsize", windowId, "100%", "100%"])
+        self._xdotoolAction(["windowactivate", "--sync", windowId])
 
     def closeWindow(self, windowId: int, timeout: int=5) -> None:
-        self._xdotool(["windowkill", windowId])
+        self._xdotoolAction(["windowkill", windowId])
         for _ in range(timeout * 10):
-            if windowId not in self.listWindows().values():
+            if not self._windowExists(windowId):
                 return
             time.sleep(0.1)
         raise TimeoutError("Waiting on window close timeout")
 
+    def close(self) -> None:
+        """
+        Release the resources held by the session. The display has to be still
+        running.
+        """
+        if self._grabber is not None:
+            self._grabber.close()
+            self._grabber = None
+
     def getScreenshot(self) ->Image.Image:
+        displayWidth, displayHeight = self._display._size
+        left, top, right, bottom = 30, 80, displayWidth - 30, displayHeight - 50
+        if self._grabber is not None:
+            # Grab only the region we are interested in; no need to crop
+            raw = self._grabber.grab({"left": left, "top": top,
+                                      "width": right - left, "height": bottom - top})
+            return Image.frombytes("RGB", raw.size, raw.rgb)
         image = self._display.grab(autocrop=False) # type: ignore
         assert isinstance(image, Image.Image)
-        displayWidth, displayHeight = self._display._size
-        return image.crop((30, 80, displayWidth - 30, displayHeight - 50))
+        return image.crop((left, top, right, bottom))
+
+    def _getMotionProbe(self) -> Image.Image:
+        """
+        Return a downsampled grayscale screenshot. It is good enough to detect
+        changes on the screen and it is significantly cheaper to compare.
+        """
+        return self.getScreenshot().convert("L").reduce(8)
 
     def waitForImmovable(self, delta: float=0.1, threshold: int=10, timeout: float=60) -> None:
         """
         Wait until the screen is immovable. Scan the screen every delta seconds
-        and if they haven't changed for threshold iterations, stop.
+        and if they haven't changed for threshold iterations, stop. While the
+        screen keeps changing (e.g., during raytracing), the scanning backs off
+        up to 8 × delta.
         """
-        start = time.time()
-        base = self.getScreenshot()
+        start = time.monotonic()
+        # We only need to know if anything changed; comparing the raw bytes
+        # stops at the first difference and allocates no difference image
+        base = self._getMotionProbe().tobytes()
         stableFor = 0
+        interval = delta
         while True:
-            time.sleep(delta)
-            current = self.getScreenshot()
-            diff = ImageChops.difference(base, current)
-            if diff.getbbox() is None:
+            time.sleep(interval)
+            current = self._getMotionProbe().tobytes()
+            if base == current:
                 stableFor += 1
+                interval = delta
             else:
                 stableFor = 0
+                interval = min(2 * interval, 8 * delta)
             if stableFor >= threshold:
                 return
             base = current
-            if time.time() - start > timeout:
+            if time.monotonic() - start > timeout:
                 raise TimeoutError("Image was not stabilized in timeout")
 
     def _dismissWarningsOrErrors(self) -> None:
         while True:
             try:
                 id = self.waitForWindows(["warning", "error"], timeout=1)
-                self._xdotool(["key", "--window", id, "Return"])
+                self._xdotoolAction(["key", "--window", id, "Return"])
             except TimeoutError:
                 break
 
@@ -169,13 +239,13 @@ class PcbnewSession:
         windows = self.listWindows()
         if "Configure KiCad Settings Path" in windows.keys():
             id = windows["Configure KiCad Settings Path"]
-            self._xdotool(["key", "--window", id, "Return"])
+            self._xdotoolAction(["key", "--window", id, "Return"])
         if "Configure Global Footprint Library Table" in windows.keys():
             id = windows["Configure Global Footprint Library Table"]
-            self._xdotool(["key", "--window", id, "Return"])
+            self._xdotoolAction(["key", "--window", id, "Return"])
         if "KiCad PCB Editor" in windows.keys():
             id = windows["KiCad PCB Editor"]
-            self._xdotool(["key", "--window", id, "Return"])
+            self._xdotoolAction(["key", "--window", id, "Return"])
         if "File Open Error" in windows.keys():
             raise RuntimeError("File Open Error")
 
@@ -195,11 +265,11 @@ class PcbnewSession:
     def start3DViewer(self) -> Generator[ViewerSession, None, None]:
         mainWindow = self.waitForWindow("pcb editor")
         try:
-            self._xdotool(["key", "--window", mainWindow, "alt+3"])
+            self._xdotoolAction(["key", "--window", mainWindow, "alt+3"])
             id = self.waitForWindow("3d viewer", 15)
         except TimeoutError:
             # No window shown, try it once more:
-            self._xdotool(["key", "--window", mainWindow, "alt+3"])
+            self._xdotoolAction(["key", "--window", mainWindow, "alt+3"])
             id = self.waitForWindow("3d viewer", 15)
         try:
             session = ViewerSession(self, id)
@@ -215,11 +285,11 @@ class ViewerSession:
         self._winId = winId
 
     def _sendKeys(self, keys: List[str]) -> None:
-        self._parent._xdotool(["key", "--window", str(self._winId)] + keys)
+        self._parent._xdotoolAction(["key", "--window", str(self._winId)] + keys)
 
     def _click(self, coords: Tuple[int, int]) -> None:
-        self._parent._xdotool(["mousemove", "--window", self._winId, coords[0],
-                               coords[1], "click", "1"])
+        self._parent._xdotoolAction(["mousemove", "--window", self._winId, coords[0],
+                                     coords[1], "click", "1"])
 
     def waitForResponsiveness(self) -> None:
         # We have to wait for board processing, we try to open preferences
@@ -230,7 +300,7 @@ class ViewerSession:
         time.sleep(1)
         self._sendKeys(["alt+p", "Down", "Return"])
         prefId = self._parent.waitForWindow("Preferences")
-        self._parent._xdotool(["key", "--window", prefId, "Escape"])
+        self._parent._xdotoolAction(["key", "--window", prefId, "Escape"])
         while "Preferences" in self._parent.listWindows():
             time.sleep(0.1)
 
@@ -276,9 +346,13 @@ class ViewerSession:
         if angle % 10 != 0:
             raise RuntimeError("Rotations can be done only in multiples of 10°")
         coords = plusButton if angle > 0 else minusButton
-        for _ in range(abs(angle // 10)):
-            self._click(coords)
-            time.sleep(0.05)
+        # Chain all the clicks into a single xdotool invocation; xdotool's own
+        # sleep keeps the pause between them
+        click = ["mousemove", "--window", self._winId, coords[0], coords[1],
+                 "click", "1", "sleep", "0.05"]
+        steps = abs(angle // 10)
+        if steps > 0:
+            self._parent._xdotoolAction(steps * click)
 
     def rotateX(self, angle: int) -> None:
         self._rotate(angle, (280, 44), (313, 44))
@@ -320,14 +394,21 @@ def duplicateKiCadSettings(outputDir: str) -> None:
 def startPcbnewSession(resolution: Tuple[int, int]=(3000, 3000),
                        board: Optional[str]=None,
                        adjustConfig: Optional[Callable[[str], None]]=None,
-                       executable: str="pcbnew") -> Generator[PcbnewSession, None, None]:
+                       executable: str="pcbnew",
+                       manageGlobalEnv: bool=True) -> Generator[PcbnewSession, None, None]:
+    """
+    Start Pcbnew in a virtual display. Unless manageGlobalEnv is set, the
+    global DISPLAY variable is left intact so multiple sessions can run
+    concurrently.
+    """
     command = [executable]
     if board is not None:
         command.append(board)
 
     try:
         p = None
-        with SmartDisplay(size=resolution) as display, TemporaryDirectory() as tempdir:
+        with SmartDisplay(size=resolution, manage_global_env=manageGlobalEnv) as display, \
+             TemporaryDirectory() as tempdir:
             try:
                 # There are some viewer settings that are persistent. In order
                 # to produce consistent results, we provide a new KiCAD config
@@ -346,6 +427,7 @@ def startPcbnewSession(resolution: Tuple[int, int]=(3000, 3000),
 
                 env = os.environ.copy()
                 env["KICAD_CONFIG_HOME"] = tempdir
+                env["DISPLAY"] = display.new_display_var
 
                 p = subprocess.Popen(command,
                         stdin=subprocess.PIPE,
@@ -353,9 +435,12 @@ def startPcbnewSession(resolution: Tuple[int, int]=(3000, 3000),
                         stderr=subprocess.PIPE,
                         env=env)
                 session = PcbnewSession(display, p, tempdir)
-                mainId = session.waitForMainWindow()
-                session.maximizeWindow(mainId)
-                yield session
+                try:
+                    mainId = session.waitForMainWindow()
+                    session.maximizeWindow(mainId)
+                    yield session
+                finally:
+                    session.close()
             except Exception as e:
                 raise GuiPuppetError(str(e), e, display.grab())
     finally:
@@ -366,13 +451,16 @@ def startPcbnewSession(resolution: Tuple[int, int]=(3000, 3000),
         except ProcessLookupError:
             pass
 
+# Lookup table binarizing the detected edges
+EDGE_THRESHOLD_LUT = [255 if p > 127 else 0 for p in range(256)]
+
 def findBoard(image: Image.Image) -> Tuple[int, int, int, int]:
     """
     Locate the board in the image a return its box
     """
     edges = image.convert("L") \
         .filter(ImageFilter.FIND_EDGES) \
-        .point( lambda p: 255 if p > 127 else 0 )
+        .point(EDGE_THRESHOLD_LUT)
     edges = edges.crop((5, 5, edges.width - 5, edges.height - 5))
     box = edges.getbbox()
     assert box is not None
@@ -399,9 +487,15 @@ def postProcessCrop(board: Union[str, pcbnew.BOARD], verticalPadding: int,
     if isinstance(board, str):
         board = pcbnew.LoadBoard(board)
     bBox = findBoardBoundingBox(board)
+    # Plans with the same orientation share the same substrate image, so we
+    # locate the board in each distinct substrate only once
+    substrateBoxes: Dict[Tuple[str, Tuple[int, int], bytes], Tuple[int, int, int, int]] = {}
     def f(plan: RenderAction, substrate: Image.Image, board: Image.Image) \
             -> Tuple[Image.Image, Tuple[int, int, int, int]]:
-        stlx, stly, sbrx, sbry = findBoard(substrate)
+        key = (substrate.mode, substrate.size, hashlib.blake2b(substrate.tobytes()).digest())
+        if key not in substrateBoxes:
+            substrateBoxes[key] = findBoard(substrate)
+        stlx, stly, sbrx, sbry = substrateBoxes[key]
         ratio = bBox.GetWidth() / (sbrx - stlx) # Number of KiCAD units per pixel
         pxVPadding = verticalPadding / ratio
         pxHPadding = horizontalPadding / ratio
@@ -409,19 +503,22 @@ def postProcessCrop(board: Union[str, pcbnew.BOARD], verticalPadding: int,
 
         if makeTransparent:
             board = board.convert("RGBA")
-            pixel = np.array(board.getpixel((1, 1)))
-
-            npBoard = np.array(board) # type: ignore
-            # This isn't the fastest way, but given the cost of raytracing it is
-            # good enough for now.
-            for rId, row in enumerate(npBoard):
-                for cId, elem in enumerate(row):
-                    fPix = np.array([int(x) for x in elem])
-                    distance = np.linalg.norm(fPix - pixel) # type: ignore
-                    if distance < 20:
-                        ImageDraw.floodfill(board, (cId, rId), (0, 0, 0, 0), thresh=30)
-
-
+            pixel = np.array(board.getpixel((1, 1)), dtype=np.int16)
+
+            # Find all pixels closer than 20 to the background color at once;
+            # we compare squared distances to avoid the square root. The
+            # differences fit into int16 and are computed in place, so we
+            # allocate only a single copy of the image.
+            diff = np.array(board, dtype=np.int16) # type: ignore
+            diff -= pixel
+            distance2 = np.einsum("ijk,ijk->ij", diff, diff, dtype=np.int32)
+            seedRows, seedCols = np.nonzero(distance2 < 20 * 20)
+            # Most of the seeds are filled by the first flood fill, skip them
+            pixels = board.load()
+            assert pixels is not None
+            for rId, cId in zip(seedRows.tolist(), seedCols.tolist()):
+                if pixels[cId, rId] != (0, 0, 0, 0):
+                    ImageDraw.floodfill(board, (cId, rId), (0, 0, 0, 0), thresh=30)
 
         btlx -= pxHPadding
         bbrx += pxHPadding
@@ -488,7 +585,8 @@ class RenderAction:
 def renderBoard(boardFile: str, renderPlans: List[RenderAction],
                 baseResolution: Tuple[int, int]=(3000, 3000),
                 bgColor1: Optional[Tuple[int, int, int]]=None,
-                bgColor2: Optional[Tuple[int, int, int]]=None) -> List[Any]:
+                bgColor2: Optional[Tuple[int, int, int]]=None,
+                parallelism: int=1) -> List[Any]:
     """
     Render KiCAD board using KiCAD's 3D renderer. Since the process has
     significant startup overhead, you can specify multiple images per board via
@@ -498,6 +596,10 @@ def renderBoard(boardFile: str, renderPlans: List[RenderAction],
     the size of virtual screen we use for rendering. Use it sufficiently large,
     the actual board will be only about 3/5 of the resolution.
 
+    The plans can be distributed among parallelism independent Pcbnew
+    sessions. Each of them runs its own virtual display and takes about 1 GB of
+    memory. Parallel sessions require mss for taking screenshots.
+
     The function return a list of post processed results. The post processing
     result depends on the post-processing function.
     """
@@ -516,11 +618,31 @@ def renderBoard(boardFile: str, renderPlans: List[RenderAction],
                 f"rgb({bgColor2[0]}, {bgColor2[1]}, {bgColor2[2]})"
         with open(colorFile, "w") as f:
             json.dump(colors, f)
-    outputs = []
-    with startPcbnewSession(resolution=baseResolution, board=boardFile, adjustConfig=updateConfig) as session:
-        with session.start3DViewer() as viewer:
-            for plan in renderPlans:
-                outputs.append(plan.execute(viewer))
+
+    sessions = min(parallelism, len(renderPlans))
+    if sessions > 1 and mss is None:
+        raise RuntimeError("Parallel rendering requires mss to be installed")
+
+    def renderInSession(plans: List[RenderAction]) -> List[Any]:
+        outputs = []
+        with startPcbnewSession(resolution=baseResolution, board=boardFile,
+                                adjustConfig=updateConfig,
+                                manageGlobalEnv=sessions <= 1) as session:
+            with session.start3DViewer() as viewer:
+                for plan in plans:
+                    outputs.append(plan.execute(viewer))
+        return outputs
+
+    if sessions <= 1:
+        return renderInSession(renderPlans)
+    # The heavy lifting is done by the Pcbnew processes, we only wait for them,
+    # so threads are sufficient. The plans are distributed round-robin.
+    outputs: List[Any] = [None] * len(renderPlans)
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = executor.map(renderInSession,
+                               [renderPlans[i::sessions] for i in range(sessions)])
+        for i, result in enumerate(results):
+            outputs[i::sessions] = result
     return outputs
 
 
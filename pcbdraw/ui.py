@@ -2,7 +2,7 @@ import platform
 import sys
 from dataclasses import dataclass
 from enum import IntEnum
-from typing import Tuple, Optional, Any, List
+from typing import Tuple, Optional, Any, Collection, FrozenSet, List, Union, cast
 
 import click
 from PIL import Image
@@ -16,6 +16,7 @@ from .plot import (PcbPlotter, PlotComponents, PlotPaste, PlotPlaceholders,
                    mm2ki)
 from .populate import populate
 from .pcbnew_common import fakeKiCADGui
+from pcbnewTransition import pcbnew # type: ignore
 
 
 class Layer(IntEnum):
@@ -42,18 +43,21 @@ class Layer(IntEnum):
 
 class KiCADLayer(click.ParamType):
     name = "KiCAD layer"
+    _by_value = {item.value: item for item in Layer}
+    _by_name = {item.name: item for item in Layer}
 
     def convert(self, value: Any, param: Optional[click.Parameter],
                 ctx: Optional[click.Context]) -> Layer:
         if isinstance(value, int):
-            if value in [item.value for item in Layer]:
-                return Layer(value)
+            layer = self._by_value.get(value)
+            if layer is not None:
+                return layer
             return self.fail(f"{value!r} is not a valid layer number", param, ctx)
         if isinstance(value, str):
-            try:
-                return Layer[value.replace(".", "_")]
-            except KeyError:
-                return self.fail(f"{value!r} is not a valid layer name", param, ctx)
+            layer = self._by_name.get(value.replace(".", "_"))
+            if layer is not None:
+                return layer
+            return self.fail(f"{value!r} is not a valid layer name", param, ctx)
         return self.fail(f"{value!r} is not of expected type", param, ctx)
 
 class CommaList(click.ParamType):
@@ -68,8 +72,23 @@ class CommaList(click.ParamType):
         values = [x.strip() for x in value.split(",")]
         return values
 
+class CommaSet(CommaList):
+    name = "Comma separated set"
+
+    def convert(self, value: Any, param: Optional[click.Parameter], # type: ignore[override]
+                ctx: Optional[click.Context]) -> FrozenSet[str]:
+        if isinstance(value, (set, frozenset)):
+            return frozenset(value)
+        return frozenset(super().convert(value, param, ctx))
+
+# The parameter types are stateless, so a single instance serves all options
+COMMA_LIST = CommaList()
+COMMA_SET = CommaSet()
+KICAD_LAYER = KiCADLayer()
+
 @dataclass
 class WarningStderrReporter:
+    __slots__ = ("silent", "triggered")
     silent: bool
 
     def __post_init__(self) -> None:
@@ -87,7 +106,7 @@ class WarningStderrReporter:
 @click.argument("output", type=click.Path(file_okay=True, dir_okay=False))
 @click.option("--style", "-s", type=str, default=None,
     help="A name of built-in style or a path to style file")
-@click.option("--libs", "-l", type=CommaList(), default=["KiCAD-base"],
+@click.option("--libs", "-l", type=COMMA_LIST, default=["KiCAD-base"],
     help="Comma separated list of libraries to use")
 @click.option("--placeholders", "-p", is_flag=True,
     help="Render placeholders to show the components origins")
@@ -99,11 +118,11 @@ class WarningStderrReporter:
     help="Specify which side of the PCB to render")
 @click.option("--mirror", is_flag=True,
     help="Mirror the board")
-@click.option("--highlight", type=CommaList(), default=[],
+@click.option("--highlight", type=COMMA_SET, default=[],
     help="Comma separated list of components to highlight")
-@click.option("--filter", "-f", type=CommaList(), default=None,
+@click.option("--filter", "-f", type=COMMA_SET, default=None,
     help="Comma separated list of components to show, if not specified, show all")
-@click.option("--vcuts", "-v", type=KiCADLayer(), default=None,
+@click.option("--vcuts", "-v", type=KICAD_LAYER, default=None,
     help="If layer specified, renders V-cuts from it")
 @click.option("--dpi", type=int, default=300,
     help="DPI for bitmap output")
@@ -113,9 +132,9 @@ class WarningStderrReporter:
     help="Do not output any warnings")
 @click.option("--werror", is_flag=True,
     help="Treat warnings as errors")
-@click.option("--resistor-values", type=CommaList(), default=[],
+@click.option("--resistor-values", type=COMMA_LIST, default=[],
     help="Comma separated list of resistor value remapping. For example, \"R1:10k,R2:470\"")
-@click.option("--resistor-flip", type=CommaList(), default=[],
+@click.option("--resistor-flip", type=COMMA_LIST, default=[],
     help="Comma separated list of resistor bands to flip")
 @click.option("--paste", is_flag=True,
     help="Add paste layer")
@@ -129,8 +148,8 @@ class WarningStderrReporter:
     help="Show library paths and quit")
 def plot(input: str, output: str, style: Optional[str], libs: List[str],
          placeholders: bool, remap: str, drill_holes: bool, side: str,
-         mirror: bool, highlight: List[str], filter: Optional[List[str]],
-         vcuts: bool, dpi: int, margin: float, silent: bool, werror: bool,
+         mirror: bool, highlight: Collection[str], filter: Optional[Collection[str]],
+         vcuts: Optional[int], dpi: int, margin: float, silent: bool, werror: bool,
          resistor_values: List[str], resistor_flip: List[str], components: bool,
          copper: bool, paste: bool, outline_width: float, show_lib_paths: bool) -> int:
     """
@@ -139,6 +158,27 @@ def plot(input: str, output: str, style: Optional[str], libs: List[str],
 
     app = fakeKiCADGui()
 
+    return plot_board(input=input, output=output, style=style, libs=libs,
+        placeholders=placeholders, remap=remap, drill_holes=drill_holes,
+        side=side, mirror=mirror, highlight=highlight, filter=filter,
+        vcuts=vcuts, dpi=dpi, margin=margin, silent=silent, werror=werror,
+        resistor_values=resistor_values, resistor_flip=resistor_flip,
+        components=components, copper=copper, paste=paste,
+        outline_width=outline_width, show_lib_paths=show_lib_paths)
+
+def plot_board(input: Union[str, pcbnew.BOARD], output: str, style: Optional[str],
+               libs: List[str], placeholders: bool, remap: str, drill_holes: bool,
+               side: str, mirror: bool, highlight: Collection[str],
+               filter: Optional[Collection[str]],
+               vcuts: Optional[int], dpi: int, margin: float, silent: bool, werror: bool,
+               resistor_values: List[str], resistor_flip: List[str], components: bool,
+               copper: bool, paste: bool, outline_width: float, show_lib_paths: bool) -> int:
+    """
+    The implementation of the plot command. Unlike the command, it also
+    accepts an already loaded board, so the board can be reused for multiple
+    plots (e.g., by populate). The parameters can be obtained by parsing the
+    command line via plot.make_context.
+    """
     plotter = PcbPlotter(input)
     plotter.setup_arbitrary_data_path(".")
     plotter.setup_env_data_path()
@@ -190,42 +230,40 @@ def plot(input: str, output: str, style: Optional[str], libs: List[str],
     save(image, output, dpi)
     return 0
 
-def build_plot_components(remap: str, highlight: List[str], filter: Optional[List[str]],
+def build_plot_components(remap: str, highlight: Collection[str],
+                          filter: Optional[Collection[str]],
                           resistor_flip: List[str], resistor_values_input: List[str]) \
                           -> PlotComponents:
-    remapping = load_remapping(remap)
-    def remapping_fun(ref: str, lib: str, name: str) -> Tuple[str, str]:
-        if ref in remapping:
-            remapped_lib, remapped_name = remapping[ref]
-            if name.endswith('.back'):
-                return remapped_lib, remapped_name + '.back'
-            else:
-                return remapped_lib, remapped_name
-        return lib, name
-
     resistor_values = {}
     for mapping in resistor_values_input:
-        key, value = tuple(mapping.split(":"))
+        key, separator, value = mapping.partition(":")
+        if separator == "":
+            raise ValueError(f"Invalid resistor value mapping '{mapping}', expected ref:value")
         resistor_values[key] = ResistorValue(value=value)
     for ref in resistor_flip:
-        field = resistor_values.get(ref, ResistorValue())
-        field.flip_bands = True
-        resistor_values[ref] = field
+        resistor_values.setdefault(ref, ResistorValue()).flip_bands = True
 
-    plot_components = PlotComponents(
-        remapping=remapping_fun,
-        resistor_values=resistor_values)
+    plot_components = PlotComponents(resistor_values=resistor_values)
 
+    # Without any remapping, the default identity of PlotComponents is enough
+    remapping = load_remapping(remap)
+    if remapping:
+        def remapping_fun(ref: str, lib: str, name: str) -> Tuple[str, str]:
+            if ref in remapping:
+                remapped_lib, remapped_name = remapping[ref]
+                if name.endswith('.back'):
+                    return remapped_lib, remapped_name + '.back'
+                else:
+                    return remapped_lib, remapped_name
+            return lib, name
+        plot_components.remapping = remapping_fun
+
+    # The bound membership tests avoid a Python frame per component, and
+    # frozenset() returns already frozen sets given by the CLI as they are
     if filter is not None:
-        filter_set = set(filter)
-        def filter_fun(ref: str) -> bool:
-            return ref in filter_set
-        plot_components.filter = filter_fun
+        plot_components.filter = frozenset(filter).__contains__
     if highlight is not None:
-        highlight_set = set(highlight)
-        def highlight_fun(ref: str) -> bool:
-            return ref in highlight_set
-        plot_components.highlight = highlight_fun
+        plot_components.highlight = frozenset(highlight).__contains__
     return plot_components
 
 def print_lib_paths(plotter: PcbPlotter) -> None:
@@ -244,9 +282,10 @@ def print_lib_paths(plotter: PcbPlotter) -> None:
 
 def processColor(c: Tuple[Optional[int], Optional[int], Optional[int]]) \
         -> Optional[Tuple[int, int, int]]:
-    if c[0] is not None and c[1] is not None and c[2] is not None:
-        return c[0], c[1], c[2]
-    return None
+    # Click fills either all the components or none of them
+    if c[0] is None:
+        return None
+    return cast(Tuple[int, int, int], c)
 
 
 @click.command()
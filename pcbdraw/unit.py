@@ -1,15 +1,39 @@
+from __future__ import annotations
+
+import re
 from decimal import Decimal
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 
 
 def erase(string: str, what: List[str]) -> str:
     """
-    Given a  string and a list of string, removes all occurrences of items from
-    what in the string
+    Given a string and a list of strings, removes all occurrences of items from
+    what in the string. The string is scanned once from left to right and at
+    each position the first matching item is removed. Text joined together by
+    a removal is not scanned again, e.g., erase("abc", ["b", "ac"]) is "ac".
     """
-    for x in what:
-        string = string.replace(x, "")
-    return string
+    return _erase_pattern(tuple(what)).sub("", string)
+
+
+@lru_cache(maxsize=None)
+def _erase_pattern(what: Tuple[str, ...]) -> re.Pattern[str]:
+    # Alternatives are tried in the given order, so at the same position an
+    # earlier item takes precedence
+    return re.compile("|".join(re.escape(x) for x in what))
+
+
+UNIT_PREFIXES = {
+    "m": Decimal('1e-3'),
+    "R": Decimal('1'),
+    "K": Decimal('1e3'),
+    "k": Decimal('1e3'),
+    "M": Decimal('1e6'),
+    "G": Decimal('1e9')
+}
+
+# A value with a unit prefix, e.g., 4k7 or 4.7k; the prefix can appear only once
+PREFIXED_VALUE_RE = re.compile("([^{0}]*)([{0}])([^{0}]*)".format("".join(UNIT_PREFIXES)))
 
 
 def read_resistance(value: str) -> Decimal:
@@ -18,32 +42,35 @@ def read_resistance(value: str) -> Decimal:
 
     This function can raise a ValueError if the value is invalid
     """
+    if value.replace(".", "", 1).isdecimal():
+        # Plain numbers are the most common values and need no cleanup
+        return Decimal(value)
     p_value = erase(value, ["Ω", "Ohms", "Ohm"]).strip()
     p_value = p_value.replace(" ", "") # Sometimes there are spaces after decimal place
-    unit_prefixes = {
-        "m": Decimal('1e-3'),
-        "R": Decimal('1'),
-        "K": Decimal('1e3'),
-        "k": Decimal('1e3'),
-        "M": Decimal('1e6'),
-        "G": Decimal('1e9')
-    }
     try:
-        numerical_value = None
-        for prefix, table in unit_prefixes.items():
-            if prefix in p_value:
-                # Example: 4k7 will have the 4 converted to Decimal(4) and 7 to Decimal(0.7)
-                # Then each gets multiplied by the factor and added, so 4000 + 700
-                # This method ensures that 4k7 and 4k700 for example yields the same result
-                split = p_value.split(prefix)
-                n_whole = Decimal(split[0]) if split[0] != "" else Decimal(0)
-                n_dec = Decimal('.'+split[1]) if split[1] != "" else Decimal(0)
-                numerical_value = n_whole * table + n_dec * table
-                break
-        if numerical_value is None:
+        match = PREFIXED_VALUE_RE.fullmatch(p_value)
+        if match is None:
             # If this fails, a decimal.InvalidOperation is raised which is handled by the Exception catch
-            numerical_value = Decimal(p_value)
-        return numerical_value
+            return Decimal(p_value)
+        # Example: 4k7 will have the 4 converted to Decimal(4) and 7 to Decimal(0.7)
+        # Then each gets multiplied by the factor and added, so 4000 + 700
+        # This method ensures that 4k7 and 4k700 for example yields the same result
+        whole, prefix, decimals = match.groups()
+        table = UNIT_PREFIXES[prefix]
+        n_whole = Decimal(whole) if whole != "" else Decimal(0)
+        n_dec = Decimal('.'+decimals) if decimals != "" else Decimal(0)
+        return n_whole * table + n_dec * table
     except Exception:
         pass
     raise ValueError(f"Cannot parse '{value}' to resistance")
+
+
+def resistor_bands(resistance: Decimal) -> Tuple[int, int, int]:
+    """
+    Given a resistance in Ohms, return the first digit, the second digit and
+    the power of ten multiplier of its color code
+    """
+    # Shifting the decimal point is exact, unlike going through float division
+    power = resistance.adjusted() - 1
+    first, second = divmod(int(resistance.scaleb(-power)), 10)
+    return first, second, power
@@ -41,6 +41,8 @@ setuptools.setup(
     ],
     extras_require={
         "dev": ["pytest", "types-pillow", "types-click", "types-PyYAML"],
+        "jinja": ["Jinja2>=2.11"],
+        "mss": ["mss"],
     },
     zip_safe=False,
     include_package_data=True,
@@ -0,0 +1,127 @@
+import io
+import os
+import sys
+import types
+
+import pytest
+
+import pcbdraw
+from pcbdraw.handlebars_shim import compile_template, handlebars_to_jinja
+
+ENGINES = ["jinja", "pybars"]
+
+# Templates that are translated to Jinja2 with their expected output
+TRANSLATED = [
+    ("<{{a}}|{{{a}}}>", {"a": "<b>&"}, "<&lt;b&gt;&amp;|<b>&>"),
+    ("{{this.a}}-{{b.c}}", {"a": 1, "b": {"c": 2}}, "1-2"),
+    ("[{{missing}}]", {}, "[]"),
+    ("a{{! a comment }}b", {}, "ab"),
+    ("{{#each items}}[{{this}}]{{/each}}", {"items": [1, 2]}, "[1][2]"),
+    ("{{#each this.d}}[{{this}}]{{/each}}", {"d": {"a": 1, "b": 2}}, "[1][2]"),
+    ("{{#each items}}x{{else}}empty{{/each}}", {"items": []}, "empty"),
+    ("{{#each items}}x{{else}}empty{{/each}}", {}, "empty"),
+    ("{{#each rows}}({{#each this.cells}}{{this}}{{/each}}){{/each}}",
+        {"rows": [{"cells": [1, 2]}, {"cells": [3]}]}, "(12)(3)"),
+    ("{{#each items}}{{{this.html}}}{{this.html}}{{/each}}",
+        {"items": [{"html": "<i>"}]}, "<i>&lt;i&gt;"),
+    ("{{#if a}}yes{{else}}no{{/if}}", {"a": False}, "no"),
+    ("{{#if a}}yes{{else}}no{{/if}}", {"a": [1]}, "yes"),
+    ("{{#each items}}{{#if this.x}}{{this.x}}{{/if}}{{/each}}",
+        {"items": [{"x": 1}, {}, {"x": 3}]}, "13"),
+]
+
+# Templates that cannot be translated and are always rendered by pybars
+FALLBACK = [
+    ("{{#each items}}{{@index}}{{/each}}", {"items": ["a", "b"]}, "01"),
+    ("{{#with a}}{{b}}{{/with}}", {"a": {"b": 1}}, "1"),
+    ("{{#each items}}{{../x}}{{/each}}", {"items": [1], "x": 2}, "2"),
+    ("{{#each items}}{{x}}{{/each}}", {"items": [{"x": 1}], "x": 2}, "1"),
+    ("{% raw %}{{a}}", {"a": 1}, "{% raw %}1"),
+    ("{{#each items}}{{/if}}", {"items": []}, None),
+    ("{{#if a}}1{{else}}2{{else}}3{{/if}}", {"a": True}, None),
+]
+
+
+def render(template, context, engine, monkeypatch):
+    pytest.importorskip("jinja2" if engine == "jinja" else "pybars")
+    monkeypatch.setenv("PCBDRAW_TEMPLATE_ENGINE", engine)
+    return "".join(compile_template(template)(context))
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("template, context, expected", TRANSLATED)
+def test_translated(template, context, expected, engine, monkeypatch):
+    assert handlebars_to_jinja(template) is not None
+    assert render(template, context, engine, monkeypatch) == expected
+
+
+@pytest.mark.parametrize("template, context, expected", FALLBACK)
+def test_fallback(template, context, expected, monkeypatch):
+    assert handlebars_to_jinja(template) is None
+    if expected is not None:
+        assert render(template, context, "pybars", monkeypatch) == expected
+
+
+def test_builtin_template(monkeypatch):
+    path = os.path.join(os.path.dirname(pcbdraw.__file__),
+                        "resources", "templates", "simple.handlebars")
+    with open(path, encoding="utf-8") as f:
+        template = f.read()
+    assert handlebars_to_jinja(template) is not None
+    context = {
+        "items": [
+            {"is_comment": True, "content": "<p>Solder & check</p>"},
+            {"is_step": True, "steps": [
+                {"img": "front_1.png", "comment": "<b>R1</b>"},
+                {"img": "back_\"2\".png", "comment": ""},
+            ]},
+        ]
+    }
+    output = render(template, context, "jinja", monkeypatch)
+    assert "<p>Solder & check</p>" in output
+    assert 'src="back_&quot;2&quot;.png"' in output
+    assert render(template, context, "pybars", monkeypatch) == output
+
+
+class FakePybars(types.ModuleType):
+    """
+    Stand-in for pybars; like pybars, the compiled template returns a str
+    """
+    def __init__(self):
+        super().__init__("pybars")
+        self.Compiler = lambda: self
+
+    def compile(self, template):
+        def render(context):
+            output = template
+            for key, value in context.items():
+                output = output.replace("{{" + key + "}}", str(value))
+            return output
+        return render
+
+
+class CountingStringIO(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, s):
+        self.writes += 1
+        return super().write(s)
+
+
+def test_pybars_single_chunk(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pybars", FakePybars())
+    monkeypatch.setenv("PCBDRAW_TEMPLATE_ENGINE", "pybars")
+    chunks = list(compile_template("<fake single chunk {{x}}>")({"x": 1}))
+    assert chunks == ["<fake single chunk 1>"]
+
+
+def test_generate_html_pybars(monkeypatch):
+    populate = pytest.importorskip("pcbdraw.populate")
+    monkeypatch.setitem(sys.modules, "pybars", FakePybars())
+    monkeypatch.setenv("PCBDRAW_TEMPLATE_ENGINE", "pybars")
+    out = CountingStringIO()
+    populate.generate_html("<fake generate_html {{items}}>", [], out)
+    assert out.getvalue() == "<fake generate_html []>"
+    assert out.writes == 1
@@ -1,4 +1,4 @@
-from pcbdraw.unit import read_resistance
+from pcbdraw.unit import erase, read_resistance, resistor_bands
 from decimal import Decimal as D
 
 
@@ -13,3 +13,25 @@ def test_read_resistance():
     assert read_resistance("470M") == D("470000000")
     assert read_resistance("4M7") == D("4700000")
     assert read_resistance("470") == D("470")
+    assert read_resistance("4.7") == D("4.7")
+
+
+def test_resistor_bands():
+    assert resistor_bands(D("4700")) == (4, 7, 2)
+    assert resistor_bands(D("100000")) == (1, 0, 4)
+    assert resistor_bands(D("10")) == (1, 0, 0)
+    assert resistor_bands(D("1")) == (1, 0, -1)
+    assert resistor_bands(D("5.6")) == (5, 6, -1)
+    assert resistor_bands(D("0.47")) == (4, 7, -2)
+    assert resistor_bands(D("0.29")) == (2, 9, -2)
+    assert resistor_bands(D("0.57")) == (5, 7, -2)
+    assert resistor_bands(D("0")) == (0, 0, -1)
+
+
+def test_erase():
+    assert erase("10 Ohms", ["Ω", "Ohms", "Ohm"]) == "10 "
+    assert erase("10 Ohm", ["Ω", "Ohms", "Ohm"]) == "10 "
+    assert erase("abab", ["a"]) == "bb"
+    assert erase("abc", []) == "abc"
+    # Single pass, the text joined by a removal is not scanned again
+    assert erase("abc", ["b", "ac"]) == "ac"